@@ -14,13 +14,14 @@ from matplotlib.ticker import MaxNLocator
 from matplotlib.patheffects import withStroke
 from matplotlib.dates import date2num
 import matplotlib.pyplot as plt
-from obspy import Stream, Trace
+from obspy import Stream, Trace, read
 from obspy import __version__ as OBSPY_VERSION
 from obspy.core import UTCDateTime
 from obspy.core.event import Catalog
 from obspy.core.util import MATPLOTLIB_VERSION
 from argparse import ArgumentParser,ArgumentDefaultsHelpFormatter
 from math import sin
+from fnmatch import fnmatchcase
 import threading
 import time
 import warnings
@@ -29,6 +30,11 @@ import sys
 from urllib.request import URLError
 import logging
 import numpy as np
+try:
+    import resource
+except ImportError:
+    # not available on Windows, no peak memory reporting then
+    resource = None
 
 
 range_func = range
@@ -92,7 +98,7 @@ class SeedlinkPlotter(tkinter.Tk):
     """
 
     def __init__(self, stream=None, events=None, myargs=None, lock=None,
-                 drum_plot=True, trace_ids=None, *args, **kwargs):
+                 drum_plot=True, registry=None, *args, **kwargs):
         tkinter.Tk.__init__(self, *args, **kwargs)
         favicon = tkinter.PhotoImage(
             file=os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -131,7 +137,14 @@ class SeedlinkPlotter(tkinter.Tk):
         self.stream = stream
         self.events = events
         self.drum_plot = drum_plot
-        self.ids = trace_ids
+        if registry is None:
+            registry = ChannelRegistry()
+        self.registry = registry
+        self.ids = registry.ids()
+        self._layout_version = registry.version
+        self._budget_exceeded = False
+        # kept time range in seconds while the memory budget shortens it
+        self._budget_retention = None
 
         # Colors
         if args.rainbow:
@@ -169,31 +182,144 @@ class SeedlinkPlotter(tkinter.Tk):
 
         with self.lock:
             # leave some data left of our start for possible processing
-            self.stream.trim(
-                starttime=self.start_time - 120, nearest_sample=False)
-            stream = self.stream.copy()
+            starttime = self._budget_starttime(self.start_time - 120)
+            self.stream.trim(starttime=starttime, nearest_sample=False)
+            # only references to the samples, the drum plot is reduced to
+            # the min/max of each pixel and the line plot is copied by
+            # stream.plot() anyway
+            stream = self.stream.slice(starttime=starttime)
+        store_nbytes = sum(tr.data.nbytes for tr in stream)
 
         try:
             logging.info(str(stream.split()))
             if not stream:
                 raise Exception("Empty stream for plotting")
 
-            if self.drum_plot :
-                stream.merge()
-                stream.trim(starttime=self.start_time, endtime=self.stop_time,
-                            pad=True, nearest_sample=False)
-            else:
-                stream.merge(-1)
-                stream.trim(starttime=self.start_time, endtime=self.stop_time)
             if self.drum_plot:
+                stream = self._decimate_drum(stream)
                 self.plot_drum(stream)
             else:
+                stream.merge(-1)
+                stream.trim(starttime=self.start_time, endtime=self.stop_time)
                 self.plot_lines(stream)
         except Exception as e:
             logging.error(e)
             pass
+        self._log_memory(store_nbytes, stream)
         self.after(int(self.args.update_time * 1000), self.plot_graph)
 
+    def _drum_pixels(self):
+        """
+        Number of horizontal pixels of all lines of the drum plot and the
+        length of one pixel in seconds.
+        """
+        pixel = self.args.x_scale * 60.0 / self.args.x_size
+        return int(round(self.args.backtrace_time / pixel)), pixel
+
+    def _decimate_drum(self, stream):
+        """
+        Reduce the drum plot data to the minimum and maximum of each pixel.
+
+        The dayplot does the same reduction, but only after merging and
+        padding the data to the whole time range as a masked array. Doing it
+        here directly on the stored int32 samples only converts the
+        decimated data to float, whatever the length of the drum.
+        """
+        npix, pixel = self._drum_pixels()
+        mins = np.empty(npix)
+        mins.fill(np.inf)
+        maxs = np.empty(npix)
+        maxs.fill(-np.inf)
+        for tr in stream:
+            # drop the margin left of the start, only references the data
+            tr = tr.slice(self.start_time, self.stop_time,
+                          nearest_sample=False)
+            if not tr.stats.npts:
+                continue
+            offset = tr.stats.starttime - self.start_time
+            first = max(0, int(offset // pixel))
+            last = min(npix, int((tr.stats.endtime - self.start_time) //
+                                 pixel) + 1)
+            if first >= last:
+                continue
+            # index of the first sample of each pixel
+            bounds = np.ceil(
+                (np.arange(first, last) * pixel - offset) *
+                tr.stats.sampling_rate).astype(np.int64)
+            bounds = bounds.clip(0, tr.stats.npts - 1)
+            mins[first:last] = np.minimum(
+                mins[first:last], np.minimum.reduceat(tr.data, bounds))
+            maxs[first:last] = np.maximum(
+                maxs[first:last], np.maximum.reduceat(tr.data, bounds))
+        data = np.empty(2 * npix)
+        data[0::2] = mins
+        data[1::2] = maxs
+        data = np.ma.masked_invalid(data)
+        stats = stream[0].stats.copy()
+        stats.starttime = self.start_time
+        # two samples per pixel, the dayplot computes the samples per line
+        # with int(), so stay slightly above to not lose one
+        stats.sampling_rate = 2.0 / pixel * (1 + 1e-9)
+        return Stream([Trace(data=data, header=stats)])
+
+    def _budget_starttime(self, starttime):
+        """
+        Shorten the kept time range if the samples of all channels and the
+        data of one plot update would not fit into the memory budget. To be
+        called with the lock held.
+        """
+        if not self.args.memory_budget or not self.stream:
+            return starttime
+        budget = self.args.memory_budget * 1024 ** 2
+        # bytes per second for all channels, a channel may be split in
+        # several traces by gaps
+        rates = dict((tr.id, tr.stats.sampling_rate * tr.data.itemsize)
+                     for tr in self.stream)
+        rate = sum(rates.values())
+        if not rate:
+            return starttime
+        if self.drum_plot:
+            # float64 min/max pairs and their mask, once here and once in
+            # the copy made by stream.plot()
+            budget -= 2 * 2 * self._drum_pixels()[0] * (8 + 1)
+        else:
+            # stream.plot() copies all plotted samples
+            rate *= 2
+        retention = max(budget, 0) / rate
+        budget_starttime = max([tr.stats.endtime for tr in self.stream])
+        budget_starttime -= retention
+        if budget_starttime > starttime:
+            if not self._budget_exceeded:
+                logging.warning(
+                    "Memory budget of %s MB exceeded, keeping only the last "
+                    "%.0f seconds" % (self.args.memory_budget, retention))
+                self._budget_exceeded = True
+            self._budget_retention = retention
+            return budget_starttime
+        if self._budget_exceeded:
+            logging.warning("Memory budget of %s MB no longer exceeded" %
+                            self.args.memory_budget)
+            self._budget_exceeded = False
+        self._budget_retention = None
+        return starttime
+
+    def _log_memory(self, store_nbytes, stream):
+        """
+        Log the size of the sample store, of the data plotted in this update
+        and the peak memory of the process.
+        """
+        nbytes = sum(tr.data.nbytes for tr in stream)
+        nbytes += sum(np.ma.getmaskarray(tr.data).nbytes for tr in stream
+                      if np.ma.isMaskedArray(tr.data))
+        msg = "Samples in memory: %.1f MB, plotted: %.1f MB" % (
+            store_nbytes / 1024.0 ** 2, nbytes / 1024.0 ** 2)
+        if self._budget_retention is not None:
+            msg += ", kept by memory budget: %.0f s" % self._budget_retention
+        peak = _get_peak_memory()
+        if peak is not None:
+            msg += ", peak memory: %.1f MB" % peak
+        logging.info(msg)
+
     def plot_drum(self, stream):
         title = stream[0].id
         if self.scale:
@@ -215,11 +341,17 @@ class SeedlinkPlotter(tkinter.Tk):
             one_tick_per_line=True,
             color=self.color,
             show_y_UTC_label=False,
+            starttime=self.start_time, endtime=self.stop_time,
             events=self.events)
 
     def plot_lines(self, stream):
+        # only rebuild the list of lanes when a new channel showed up
+        if self.registry.version != self._layout_version:
+            self._layout_version = self.registry.version
+            self.ids = self.registry.ids()
+        present = set(tr.id for tr in stream)
         for id_ in self.ids:
-            if not any([tr.id == id_ for tr in stream]):
+            if id_ not in present:
                 net, sta, loc, cha = id_.split(".")
                 header = {'network': net, 'station': sta, 'location': loc,
                           'channel': cha, 'starttime': self.start_time}
@@ -318,12 +450,15 @@ class SeedlinkPlotter(tkinter.Tk):
 
 class SeedlinkUpdater(SLClient):
 
-    def __init__(self, stream, myargs=None, lock=None):
+    def __init__(self, stream, myargs=None, lock=None, recorder=None,
+                 registry=None):
         # loglevel NOTSET delegates messages to parent logger
         super(SeedlinkUpdater, self).__init__()
         self.stream = stream
         self.lock = lock
         self.args = myargs
+        self.recorder = recorder
+        self.registry = registry
 
    
     def packet_handler(self, count, slpack):
@@ -368,6 +503,18 @@ class SeedlinkUpdater(SLClient):
                 self.__class__.__name__ + ": blockette contains no trace")
             return False
 
+        # keep the samples in their compact native dtype, miniSEED counts
+        # fit in int32 so only wider integers are narrowed
+        if trace.data.dtype.kind == "i" and trace.data.dtype.itemsize > 4:
+            trace.data = trace.data.astype(np.int32)
+
+        if self.registry is not None:
+            self.registry.register(trace.id)
+
+        # archive the record as received
+        if self.recorder is not None:
+            self.recorder.add(trace, slpack.msrecord)
+
         # new samples add to the main stream which is then trimmed
         with self.lock:
             self.stream += trace
@@ -388,6 +535,8 @@ class SeedlinkUpdater(SLClient):
             sta = stream.station
             selectors = stream.get_selectors()
             for selector in selectors:
+                # drop the optional type suffix, e.g. "HH?.D"
+                selector = selector.split(".")[0]
                 if len(selector) == 3:
                     loc = ""
                 else:
@@ -398,6 +547,274 @@ class SeedlinkUpdater(SLClient):
         return ids
 
 
+class ChannelRegistry():
+    """
+    Registry of the channels actually received, keyed by trace id.
+
+    The requested ids (see `SeedlinkUpdater.getTraceIDs`) may contain
+    wildcards, e.g. "G.SSB.00.HH?", that never match a real trace id. Every
+    received trace id is registered and matched once against the requested
+    ids, selectors that did not get any data yet are kept as placeholders.
+    """
+    def __init__(self, selector_ids=()):
+        # trace id -> set of indices of the matched selectors, empty for
+        # channels not matching any selector
+        self._channels = {}
+        self._ids = None
+        self._lock = threading.Lock()
+        # incremented each time a new channel shows up
+        self.version = 0
+        self.set_selector_ids(selector_ids)
+
+    def set_selector_ids(self, selector_ids):
+        """
+        Set the requested ids, once the SeedLink client is initialized.
+        """
+        patterns = []
+        for id_ in selector_ids:
+            net, sta, loc, cha = id_.split(".")
+            # a selector without location code matches all locations
+            patterns.append(".".join((net, sta, loc or "*", cha)))
+        with self._lock:
+            self.selector_ids = list(selector_ids)
+            self._patterns = patterns
+            for trace_id in self._channels:
+                self._channels[trace_id] = self._match(trace_id)
+            self._ids = None
+            self.version += 1
+
+    def _match(self, trace_id):
+        return set(i for i, pattern in enumerate(self._patterns)
+                   if fnmatchcase(trace_id, pattern))
+
+    def register(self, trace_id):
+        """
+        Register a received trace id. Returns True if it is a new channel.
+        """
+        if trace_id in self._channels:
+            return False
+        with self._lock:
+            if trace_id in self._channels:
+                return False
+            self._channels[trace_id] = self._match(trace_id)
+            self._ids = None
+            self.version += 1
+        return True
+
+    def ids(self):
+        """
+        Sorted list of ids to display: all received channels plus the
+        requested ids of selectors without any data.
+        """
+        with self._lock:
+            if self._ids is None:
+                matched = set()
+                for indices in self._channels.values():
+                    matched.update(indices)
+                ids = set(self._channels)
+                ids.update(id_ for i, id_ in enumerate(self.selector_ids)
+                           if i not in matched)
+                self._ids = sorted(ids)
+            return self._ids
+
+
+class SDSRecorder():
+    """
+    Record received data into a local SDS archive of miniSEED files
+    (YEAR/NET/STA/CHAN.D/NET.STA.LOC.CHAN.D.YEAR.DAY).
+
+    The miniSEED records are archived as received, without decoding and
+    encoding again. They are only buffered per channel on ingest and
+    appended in bulk by a separate writer thread, so the SeedLink thread
+    never waits on disk I/O or on the plotting lock.
+    """
+    def __init__(self, root, flush_time=10, retention=None,
+                 max_pending=None):
+        self.root = root
+        self.flush_time = flush_time
+        self.retention = retention
+        # maximum time span in seconds kept per channel while writing fails
+        self.max_pending = max_pending
+        # trace id -> list of (starttime, endtime, record)
+        self._buffer = {}
+        self._buffer_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._running = True
+        # pool of open file handles: path -> (day, file)
+        self._files = {}
+        self._day = None
+        # trace id -> end time of the data already in the archive
+        self._archived = {}
+
+    def add(self, trace, record):
+        """
+        Queue a received miniSEED record for writing, `trace` is the
+        decoded record. Cheap, to be called from the packet handler.
+        """
+        entry = (trace.stats.starttime, trace.stats.endtime, record)
+        with self._buffer_lock:
+            self._buffer.setdefault(trace.id, []).append(entry)
+
+    def run(self):
+        """
+        Flush the buffer every `flush_time` seconds until stopped. To be run
+        in a (daemon) thread.
+        """
+        while self._running:
+            self._wakeup.wait(self.flush_time)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(e)
+        self.close()
+
+    def stop(self):
+        """
+        Ask the writer thread to do a last flush and close all files.
+        """
+        self._running = False
+        self._wakeup.set()
+
+    def flush(self):
+        """
+        Write all buffered records, one write per channel and day file.
+        """
+        with self._buffer_lock:
+            buffer, self._buffer = self._buffer, {}
+        for id_, records in buffer.items():
+            try:
+                self._write(id_, records)
+            except Exception as e:
+                logging.error("%s: %s" % (id_, e))
+                self._requeue(id_, records)
+        today = UTCDateTime()
+        today = (today.year, today.julday)
+        # keep the handles of the current day pooled, close the others (old
+        # data from the initial backfill or from the last day)
+        for path, (day, fh) in list(self._files.items()):
+            if day != today:
+                del self._files[path]
+                try:
+                    fh.close()
+                except Exception as e:
+                    logging.error("%s: %s" % (path, e))
+        if today != self._day:
+            self._day = today
+            self._purge()
+
+    def close(self):
+        """
+        Flush remaining data and close all open files.
+        """
+        self.flush()
+        for path, (day, fh) in self._files.items():
+            try:
+                fh.close()
+            except Exception as e:
+                logging.error("%s: %s" % (path, e))
+        self._files.clear()
+
+    def _requeue(self, id_, records):
+        """
+        Put records that could not be written back into the buffer, keeping
+        at most `max_pending` seconds of data for the channel.
+        """
+        with self._buffer_lock:
+            records = records + self._buffer.get(id_, [])
+            if self.max_pending is not None:
+                oldest = max(end for start, end, record in records) - \
+                    self.max_pending
+                kept = [r for r in records if r[1] >= oldest]
+                if len(kept) < len(records):
+                    logging.warning(
+                        "%s: dropping %i records not written to the archive"
+                        % (id_, len(records) - len(kept)))
+                records = kept
+            self._buffer[id_] = records
+
+    def _write(self, id_, records):
+        """
+        Append the records of one channel to the day files of their start
+        times, skipping data already in the archive.
+        """
+        chunks = {}
+        for start, end, record in records:
+            chunks.setdefault((start.year, start.julday), []).append(
+                (start, end, record))
+        for day in sorted(chunks):
+            records = chunks[day]
+            # opening the file reads the end time of the archived data
+            fh = self._get_file(id_, records[0][0])
+            archived = self._archived.get(id_)
+            data = []
+            for start, end, record in records:
+                if archived is not None and end <= archived:
+                    continue
+                data.append(record)
+                archived = end
+            if not data:
+                continue
+            fh.write(b"".join(data))
+            self._archived[id_] = archived
+
+    def _get_file(self, id_, starttime):
+        day = (starttime.year, starttime.julday)
+        net, sta, loc, cha = id_.split(".")
+        filename = "%s.%s.%s.%s.D.%04d.%03d" % (
+            net, sta, loc, cha, starttime.year, starttime.julday)
+        path = os.path.join(self.root, "%04d" % starttime.year, net, sta,
+                            cha + ".D", filename)
+        try:
+            return self._files[path][1]
+        except KeyError:
+            pass
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        elif os.path.isfile(path) and os.path.getsize(path):
+            # data from a previous run, e.g. the backfill requested at
+            # startup overlaps with what was archived before the restart
+            try:
+                endtime = max(tr.stats.endtime for tr in read(
+                    path, format="MSEED", headonly=True))
+            except Exception as e:
+                logging.error("%s: %s" % (path, e))
+            else:
+                archived = self._archived.get(id_)
+                if archived is None or endtime > archived:
+                    self._archived[id_] = endtime
+        # unbuffered, so that a failing write shows up in _write and the
+        # records are kept for the next flush
+        fh = open(path, "ab", buffering=0)
+        self._files[path] = (day, fh)
+        return fh
+
+    def _purge(self):
+        """
+        Remove day files older than the retention time.
+        """
+        if self.retention is None:
+            return
+        cutoff = UTCDateTime() - self.retention
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                parts = filename.split(".")
+                if len(parts) != 7:
+                    continue
+                try:
+                    day = UTCDateTime(year=int(parts[5]), julday=int(parts[6]))
+                except ValueError:
+                    continue
+                if day + 86400 <= cutoff:
+                    path = os.path.join(dirpath, filename)
+                    logging.info("Purging " + path)
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        logging.error("%s: %s" % (path, e))
+
+
 class EventUpdater():
     """
     Fetch list of seismic events
@@ -455,6 +872,20 @@ class EventUpdater():
             self.events.extend(events)
 
 
+def _get_peak_memory():
+    """
+    Peak resident memory of the process in MB, None if it can not be
+    determined.
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        if sys.platform == "darwin":
+            peak /= 1024.0
+        return peak / 1024.0
+    return None
+
+
 def _parse_time_with_suffix_to_seconds(timestring):
     """
     Parse a string to seconds as float.
@@ -585,6 +1016,26 @@ def main():
              ' The following suffixes can be used as well: "s" for seconds, '
              '"m" for minutes, "h" for hours and "d" for days.',
         type=_parse_time_with_suffix_to_minutes)
+    parser.add_argument(
+        '--memory_budget', required=False, default=None, type=float,
+        help='maximum memory in MB used for the samples of all channels. '
+             'The plotted time range is shortened if it is exceeded.')
+    parser.add_argument(
+        '--sds_archive', required=False, default=None, type=str,
+        help='record the received data into a SDS archive in this directory')
+    parser.add_argument(
+        '--sds_flush_time', required=False, default=10,
+        help='time in seconds between each write of the SDS archive.'
+        ' The following suffixes can be used as well: "s" for seconds, '
+        '"m" for minutes, "h" for hours and "d" for days.',
+        type=_parse_time_with_suffix_to_seconds)
+    parser.add_argument(
+        '--sds_retention', required=False, default=None,
+        help='time in seconds to keep the day files of the SDS archive, '
+        'older ones are removed. Default is to keep everything. '
+        ' The following suffixes can be used as well: "s" for seconds, '
+        '"m" for minutes, "h" for hours and "d" for days.',
+        type=_parse_time_with_suffix_to_seconds)
     parser.add_argument('-f', '--fullscreen', default=False,
                         action="store_true",
                         help='set to full screen on startup')
@@ -619,8 +1070,22 @@ def main():
     events = Catalog()
     lock = threading.Lock()
 
+    # start the archive writer first, so that no packet is missed
+    recorder = None
+    if args.sds_archive is not None:
+        recorder = SDSRecorder(args.sds_archive,
+                               flush_time=args.sds_flush_time,
+                               retention=args.sds_retention,
+                               max_pending=args.backtrace_time)
+        recorder_thread = threading.Thread(target=recorder.run)
+        recorder_thread.setDaemon(True)
+        recorder_thread.start()
+
     # cl is the seedlink client
-    seedlink_client = SeedlinkUpdater(stream, myargs=args, lock=lock)
+    # channels get registered as packets come in
+    registry = ChannelRegistry()
+    seedlink_client = SeedlinkUpdater(stream, myargs=args, lock=lock,
+                                      recorder=recorder, registry=registry)
     seedlink_client.slconn.set_sl_address(args.seedlink_server)
     seedlink_client.multiselect = args.seedlink_streams
 
@@ -644,7 +1109,7 @@ def main():
     seedlink_client.begin_time = (now - args.backtrace_time).format_seedlink()
 
     seedlink_client.initialize()
-    ids = seedlink_client.getTraceIDs()
+    registry.set_selector_ids(seedlink_client.getTraceIDs())
     # start cl in a thread
     thread = threading.Thread(target=seedlink_client.run)
     thread.setDaemon(True)
@@ -658,13 +1123,22 @@ def main():
         thread.setDaemon(True)
         thread.start()
 
-    # Wait few seconds to get data for the first plot
-    time.sleep(2)
-
-    master = SeedlinkPlotter(stream=stream, events=events, myargs=args,
-                             lock=lock, drum_plot=drum_plot,
-                             trace_ids=ids)
-    master.mainloop()
+    try:
+        # Wait few seconds to get data for the first plot
+        time.sleep(2)
+
+        master = SeedlinkPlotter(stream=stream, events=events, myargs=args,
+                                 lock=lock, drum_plot=drum_plot,
+                                 registry=registry)
+        master.mainloop()
+    finally:
+        peak = _get_peak_memory()
+        if peak is not None:
+            logging.info("Peak memory: %.1f MB" % peak)
+        # write out what is still buffered for the archive, also on Ctrl-C
+        if recorder is not None:
+            recorder.stop()
+            recorder_thread.join(30)
 
 if __name__ == '__main__':
     main()